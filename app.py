@@ -5,15 +5,29 @@ import openai
 import pandas as pd
 import re
 import json
+import copy
+import math
+import hashlib
+import unicodedata
+from collections import Counter, deque
+from functools import lru_cache
 import boto3
 from botocore.exceptions import ClientError
 import threading
 from threading import Event
 import logging
 import time
+import statistics
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import click
 from typing_extensions import override
 from openai import AssistantEventHandler, OpenAI
 
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow output of /api/kpis is only available with pyarrow installed
+    pa = None
+
 secret_name = "openai_api_key"
 region_name = "eu-central-1"
 
@@ -42,6 +56,9 @@ if not api_key:
     raise Exception("OPENAI_API_KEY is not set in the environment.")
 client = openai.OpenAI(api_key=api_key)
 
+# Token for the admin endpoints; admin endpoints are disabled if it is not set
+admin_token = secret_dict.get('ADMIN_TOKEN')
+
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # Set a secret key for session management
 
@@ -53,6 +70,44 @@ UPLOAD_FOLDER = os.path.join(base_dir, 'uploads', 'docs')
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xlsx'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Folder for the precomputed batch reports, one subfolder per run
+REPORTS_FOLDER = os.path.join(base_dir, 'reports')
+BATCH_MAX_WORKERS = 4
+
+# Offline evaluation set for the local intent router
+ROUTER_EVAL_FILE = os.path.join(base_dir, 'router_eval.json')
+
+# Model routing for free-text questions: short questions without domain terms run on
+# the light tier, everything else (incl. all KPI analyses) on the full assistant.
+# Run options of a tier override the assistant's settings for that run only.
+app.config['MODEL_ROUTING_ENABLED'] = True
+app.config['LIGHT_TIER_MAX_WORDS'] = 12
+app.config['HEAVY_TIER_KEYWORDS'] = [
+    'ziel', 'makler', 'bestand', 'geschaeft', 'produktiv', 'quote', 'kpi', 'target', 'sparte',
+    'produkt', 'account', 'team', 'portfolio', 'vertrieb', 'praemie', 'umsatz', 'analys', 'vergleich'
+]
+app.config['MODEL_TIERS'] = {
+    "heavy": {},
+    "light": {
+        "model": "gpt-4o-mini",
+        "tools": [],
+        "instructions": "Du bist der Zielnavigator, ein Assistent für Account Manager im Maklervertrieb. Beantworte kurze Rückfragen knapp und freundlich auf Deutsch und beziehe dich auf den bisherigen Gesprächsverlauf."
+    }
+}
+
+# KPI data for /api/kpis; the team filter uses KPI_TEAM_COLUMN of that sheet
+app.config['KPI_DATA_FILE'] = os.path.join(UPLOAD_FOLDER, 'maklervertrieb_zahlen.xlsx')
+app.config['KPI_TEAM_COLUMN'] = 'Team'
+app.config['KPI_MAX_PAGE_SIZE'] = 10000
+
+# Allow overriding the routing and KPI settings via FLASK_-prefixed environment variables
+app.config.from_prefixed_env()
+
+# select_model_tier may return any of these tiers, so an override must keep all of them
+missing_model_tiers = {"heavy", "light"} - set(app.config['MODEL_TIERS'])
+if missing_model_tiers:
+    raise Exception(f"MODEL_TIERS is missing the tiers: {', '.join(sorted(missing_model_tiers))}")
+
 task_completed = Event()
 analysis_result = {}
 
@@ -103,39 +158,44 @@ temp_thread = None
 user_id = None
 mock_user = "Max Mustermann"
 kb_files = ['Input_1_sales.pdf', 'Zieldefinition MV v2.pdf', 'Maklervertrieb Zahlen v0.4.docx']
+ASSISTANT_ID = "asst_trlWRLh1q6z7OWMv2NWJI8OZ" #assistant without functions
 
 def initialize_assistant_for_session():
     global assistant
-    assistant = client.beta.assistants.retrieve("asst_trlWRLh1q6z7OWMv2NWJI8OZ") #assistant without functions
+    assistant = client.beta.assistants.retrieve(ASSISTANT_ID)
     #assistant = client.beta.assistants.retrieve("asst_7Hx0vFUQZDlJd1aSRm8HjtjR") #assistant with functions
     return assistant
     
+def create_thread_message(thread_id, role, content, max_wait_seconds=None):
+    # Wait until there's no active run before creating a new message
+    waited_seconds = 0
+    while True:
+        try:
+            return client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role=role,
+                content=content,
+            )
+        except openai.BadRequestError as e:
+            if "while a run" in str(e) and (max_wait_seconds is None or waited_seconds < max_wait_seconds):
+                time.sleep(1)  # Wait for a second before retrying
+                waited_seconds += 1
+            else:
+                raise  # Re-raise any other exceptions
+
 def run_prompts_with_temp_thread(function, prompt_steps):
     with current_app.app_context():
         global user_id
         global temp_assistant
         global temp_thread
         
-        if temp_assistant is None: temp_assistant = client.beta.assistants.retrieve("asst_trlWRLh1q6z7OWMv2NWJI8OZ")
+        if temp_assistant is None: temp_assistant = client.beta.assistants.retrieve(ASSISTANT_ID)
         multiple = True
         
         for i, step in enumerate(prompt_steps):
             if temp_thread is None: temp_thread = client.beta.threads.create()
             
-            # Wait until there's no active run before creating a new message
-            while True:
-                try:
-                    thread_message = client.beta.threads.messages.create(
-                        thread_id=temp_thread.id,
-                        role="user",
-                        content=step,
-                    )
-                    break  # Exit the loop if the message is created successfully
-                except openai.BadRequestError as e:
-                    if "while a run" in str(e):
-                        time.sleep(1)  # Wait for a second before retrying
-                    else:
-                        raise  # Re-raise any other exceptions
+            thread_message = create_thread_message(temp_thread.id, "user", step)
             
             event_handler = EventHandler()
             
@@ -149,48 +209,56 @@ def run_prompts_with_temp_thread(function, prompt_steps):
                 multiple = None
             handle_streaming_response(temp_stream, user_id, None, None, multiple)
 
+TARGET_COLUMNS = ['Target_1', 'Target_2', 'Target_3']
+KPI_COLUMNS = ['KPI_1', 'KPI_2', 'KPI_3']
+
+# Excel-Dateien werden nur neu eingelesen, wenn sie sich geändert haben
+kpi_data_cache = {}
+kpi_data_lock = threading.Lock()
+
+def load_kpi_data(file_path):
+    mtime = os.path.getmtime(file_path)
+    with kpi_data_lock:
+        cached = kpi_data_cache.get(file_path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, pd.read_excel(file_path, engine='openpyxl'))
+            kpi_data_cache[file_path] = cached
+    return cached[1]
+
+def aggregate_kpis(df, broker_ids=None, team=None, team_column='Team', per_broker=True):
+    # Filter and aggregate all requested brokers in a single group-by
+    mask = pd.Series(True, index=df.index)
+    if broker_ids:
+        mask &= df['BrokerID'].isin(broker_ids)
+    if team is not None:
+        # Non-numeric team columns are compared as text, as Excel may mix numbers and strings
+        team_values = df[team_column] if pd.api.types.is_numeric_dtype(df[team_column]) else df[team_column].astype(str)
+        mask &= team_values == team
+    group_columns = ['BrokerID', 'Sparte', 'Produkt'] if per_broker else ['Sparte', 'Produkt']
+    return df.loc[mask].groupby(group_columns, sort=True)[TARGET_COLUMNS + KPI_COLUMNS].sum().reset_index()
+
 def soll_ist_analyze(broker_number, file_path):
-    df = pd.read_excel(file_path, engine='openpyxl')
-    broker_data = df.loc[df['BrokerID'] == int(broker_number)]
-    if broker_data.empty:
+    df = load_kpi_data(file_path)
+    grouped_data = aggregate_kpis(df, broker_ids=[int(broker_number)], per_broker=False)
+    if grouped_data.empty:
         return f"No data found for broker number: {broker_number}"
-    grouped_data = broker_data.groupby(['Sparte', 'Produkt']).agg({
-        'Target_1': 'sum',
-        'Target_2': 'sum',
-        'Target_3': 'sum',
-        'KPI_1': 'sum',
-        'KPI_2': 'sum',
-        'KPI_3': 'sum'
-    }).reset_index()
     performance_list = []
-    for index, row in grouped_data.iterrows():
-        division = row['Sparte']
-        product = row['Produkt']
-        targets = {
-            "Target_1": row['Target_1'],
-            "Target_2": row['Target_2'],
-            "Target_3": row['Target_3']
-        }
-        kpis = {
-            "KPI_1": row['KPI_1'],
-            "KPI_2": row['KPI_2'],
-            "KPI_3": row['KPI_3']
-        }
+    for row in grouped_data.to_dict('records'):
         performance = {
-            "Division": division,
-            "Product": product,
-            "Targets": targets,
-            "Achievements": kpis
+            "Division": row['Sparte'],
+            "Product": row['Produkt'],
+            "Targets": {column: row[column] for column in TARGET_COLUMNS},
+            "Achievements": {column: row[column] for column in KPI_COLUMNS}
         }
         performance_list.append(performance)
     return performance_list
 
-def target_analyze():
+def target_analyze(account_manager=mock_user):
     logger.info('target_analyze function triggered')
     
     prompt_steps = [
-        """
-        Erstelle eine Übersicht der Zielerreichung für Account Manager Max Mustermann und seine Makler Accounts. Durchlaufe dafür folgende Schritte, nenne die Schritte aber nicht in deiner Antwort.
+        f"""
+        Erstelle eine Übersicht der Zielerreichung für Account Manager {account_manager} und seine Makler Accounts. Durchlaufe dafür folgende Schritte, nenne die Schritte aber nicht in deiner Antwort.
         
         Schritt 1: Extrahiere die Kennzahlen für Zielart 1 Abteilungsziele. Ermittle die Zielerreichung und fasse das Ergebnis wie folgt zusammen:
         "### Abteilungsziele:
@@ -270,12 +338,12 @@ def get_produktive_makler():
     with app.app_context():
         return run_prompts_with_temp_thread("productive_broker_analyze", prompt_steps)
         
-def target_gap():
+def target_gap(account_manager=mock_user):
     logger.info('target_gap function triggered')
     
     prompt_steps = [
-        """
-        Analysiere das Maklerportfolio von Account Manager Max Mustermann und mache Vorschläge, wie dieser seine persönlichen Ziele effizient erreichen kann. 
+        f"""
+        Analysiere das Maklerportfolio von Account Manager {account_manager} und mache Vorschläge, wie dieser seine persönlichen Ziele effizient erreichen kann. 
         Berücksichtige dabei die Korrelationen zwischen den verschiedenen Zielarten. Durchlaufe dafür folgende Schritte, nenne die Schritte aber nicht in deiner Antwort.
 
         Schritt 1: Analysiere das Maklerportfolio für die verschiedenen Messgrößen in der Zielart 3 Persönliche Ziele und stelle dar, welche Kennzahlen sich in welcher Höhe verändern müssten, um diese Ziele zu erreichen. Konzentriere dich auf diejenigen Kennzahlen, die aufgrund einer Zielkorrelation den größten Effekt auf die Zielerreichung der meisten Ziele haben. Fasse das Ergebnis wie folgt zusammen:
@@ -320,11 +388,11 @@ def create_appointment_task():
 def create_appointment():
     return 'Termin wurde im Kalender hinterlegt.'
     
-def productive_broker_analyze():
+def productive_broker_analyze(account_manager=mock_user):
     logger.info('productive_broker_analyze function triggered')
     prompt_steps = [
-        """
-        Ermittle die Makler von Account Manager Max Mustermann, die die Zielvorgaben für die Messgröße Produktive Makler innerhalb der Zielart 3 Persönliche Ziele erreichen. 
+        f"""
+        Ermittle die Makler von Account Manager {account_manager}, die die Zielvorgaben für die Messgröße Produktive Makler innerhalb der Zielart 3 Persönliche Ziele erreichen. 
         Entnimm die Einteilung "produktiv ja/nein" direkt der korrespondierenden Tabelle und Spalte in Maklervertrieb Zahlen. Antworte entsprechend folgendem Musterbeispiel und füge keinen zusätzlichen Text hinzu:
         "Im Folgenden findest Du eine Auflistung deiner produktiven Makler:
         
@@ -349,6 +417,27 @@ def productive_broker_analyze():
     
     return prompt_steps
 
+# Analysen, die im Batch-Modus je Account Manager vorberechnet werden
+report_functions = {
+    "target_analyze": target_analyze,
+    "target_gap": target_gap,
+    "productive_broker_analyze": productive_broker_analyze
+}
+
+# Vorschläge für Folgefragen, abhängig von Schlüsselbegriffen in der Antwort
+follow_up_questions = {
+    'quantitative zielerreichung': [
+        "Wie erreiche ich meine persönlichen Ziele?",
+        "Wie erreichen wir unsere Teamziele?",
+        "Welcher Vertriebsschwerpuntk könnte mir dabei helfen, meine persönlichen Ziele zu erreichen?"
+    ],
+    'persönlichen ziele': [
+        "Wird einer der Top Accounts zukünftig produktiv?",
+        "Haben andere KollegInnen im MV ähnliche Vertriebsschwerpunkte und Geschäftsverteilungen?"
+    ]
+}
+default_follow_up_questions = ["Erzähle mir mehr."]
+
 def generate_follow_up_questions(response_text):
     if not isinstance(response_text, str):
         response_text = str(response_text)
@@ -356,15 +445,11 @@ def generate_follow_up_questions(response_text):
     response_lower = response_text.lower()
     questions = []
     
-    if 'quantitative zielerreichung' in response_lower:
-        questions.append("Wie erreiche ich meine persönlichen Ziele?")
-        questions.append("Wie erreichen wir unsere Teamziele?")
-        questions.append("Welcher Vertriebsschwerpuntk könnte mir dabei helfen, meine persönlichen Ziele zu erreichen?")
-    if 'persönlichen ziele' in response_lower:
-        questions.append("Wird einer der Top Accounts zukünftig produktiv?")
-        questions.append("Haben andere KollegInnen im MV ähnliche Vertriebsschwerpunkte und Geschäftsverteilungen?")
+    for keyword, keyword_questions in follow_up_questions.items():
+        if keyword in response_lower:
+            questions.extend(keyword_questions)
     if not questions:
-        questions.append("Erzähle mir mehr.")
+        questions.extend(default_follow_up_questions)
     
     return questions
 
@@ -565,14 +650,17 @@ class EventHandler(AssistantEventHandler):
         logging.info("Thread run completed")
 
 # Function to handle streaming responses from OpenAI
-def handle_streaming_response(user_input, user_id, prompts, assistant_id, multiple):
+def handle_streaming_response(user_input, user_id, prompts, assistant_id, multiple, model_tier="heavy"):
     global analysis_result
     global assistant
     global thread
     global combined_message
     suggestions = []
+    start_time = time.perf_counter()
+    first_token_seconds = None
 
     try:
+        run_options = app.config['MODEL_TIERS'][model_tier]
         combined_message = ""
         suggestions = generate_follow_up_questions(user_input)
         if assistant is None: assistant = client.beta.assistants.retrieve(assistant_id)
@@ -595,12 +683,15 @@ def handle_streaming_response(user_input, user_id, prompts, assistant_id, multip
                 thread_id=thread.id,
                 assistant_id=assistant.id,
                 event_handler=event_handler,
+                **run_options,
             )
 
             # Collect response parts
             with stream as stream_context:
                 for chunk in stream_context:
                     response = ''.join(stream_context.results)
+                    if first_token_seconds is None and response:
+                        first_token_seconds = time.perf_counter() - start_time
                     #response_parts.append(response)
                     full_response = combined_message + response
                     # Update streaming response
@@ -634,16 +725,155 @@ def handle_streaming_response(user_input, user_id, prompts, assistant_id, multip
         # Finalize the analysis result
         analysis_result['messages'] = combined_message
         analysis_result['suggestions'] = suggestions
-        logging.info("Task completed successfully")
+        total_seconds = time.perf_counter() - start_time
+        record_routing_latency(model_tier, first_token_seconds, total_seconds)
+        logging.info(f"Task completed successfully on {model_tier} tier in {total_seconds:.2f}s")
         task_completed.set()
 
     except Exception as e:
         logging.error(f"Error during OpenAI streaming: {str(e)}", exc_info=True)
+        record_routing_latency(model_tier, first_token_seconds, time.perf_counter() - start_time, failed=True)
         if user_id in streaming_responses:
             streaming_responses[user_id].append({"role": "assistant", "content": f"Error: {str(e)}"})
         else:
             streaming_responses[user_id] = [{"role": "assistant", "content": f"Error: {str(e)}"}]
 
+# Batch-Modus: Analysen je Account Manager vorberechnen und als Morgenbericht speichern
+batch_runs = {}
+batch_runs_lock = threading.Lock()
+
+def get_report_path(run_id, account_manager, report_name):
+    # The hash of the exact name keeps names apart that reduce to the same (or an empty) slug
+    name_hash = hashlib.sha256(account_manager.encode('utf-8')).hexdigest()[:16]
+    slug = secure_filename(account_manager) or "account_manager"
+    return os.path.join(REPORTS_FOLDER, secure_filename(run_id), f"{slug}-{name_hash}__{report_name}.json")
+
+def load_precomputed_report(account_manager, report_name, run_id=None):
+    # Without a run_id only today's reports are served, older ones are outdated
+    report_path = get_report_path(run_id or time.strftime('%Y-%m-%d'), account_manager, report_name)
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path, encoding='utf-8') as f:
+        report = json.load(f)
+    return report if report.get('account_manager') == account_manager else None
+
+def save_report(run_id, account_manager, report_name, response_text):
+    report_path = get_report_path(run_id, account_manager, report_name)
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    report = {
+        "account_manager": account_manager,
+        "report": report_name,
+        "run_id": run_id,
+        "generated_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "response": response_text,
+        "content": format_message_content(response_text)
+    }
+    # Write to a temporary file first so an interrupted run never leaves a partial checkpoint
+    tmp_path = report_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False)
+    os.replace(tmp_path, report_path)
+    return report
+
+def run_report(account_manager, report_name):
+    # Each report runs on its own thread so parallel runs do not share any conversation state
+    prompt_steps = report_functions[report_name](account_manager)
+    report_thread = client.beta.threads.create()
+    response_parts = []
+
+    try:
+        for step in prompt_steps:
+            client.beta.threads.messages.create(
+                thread_id=report_thread.id,
+                role="user",
+                content=step,
+            )
+            with client.beta.threads.runs.stream(
+                thread_id=report_thread.id,
+                assistant_id=ASSISTANT_ID,
+                event_handler=EventHandler(),
+            ) as event_handler:
+                event_handler.until_done()
+                response_parts.append(''.join(event_handler.results))
+    finally:
+        # The response is kept in memory for saving, the thread itself is no longer needed
+        try:
+            client.beta.threads.delete(report_thread.id)
+        except Exception as e:
+            logging.error(f"Error deleting report thread {report_thread.id}: {str(e)}")
+
+    return "\n".join(response_parts)
+
+def claim_batch_run(run_id):
+    # Creates the status of a run, or returns None if the run is already running
+    with batch_runs_lock:
+        if batch_runs.get(run_id, {}).get('status') == "running":
+            return None
+        status = {"status": "running", "run_id": run_id, "completed": [], "skipped": [], "failed": {}}
+        batch_runs[run_id] = status
+        return status
+
+def run_batch_reports(account_managers, run_id=None, max_workers=BATCH_MAX_WORKERS, status=None):
+    run_id = run_id or time.strftime('%Y-%m-%d')
+    if status is None:
+        status = claim_batch_run(run_id)
+        if status is None:
+            raise RuntimeError(f"Batch run {run_id} is already running")
+    max_workers = min(max(max_workers, 1), BATCH_MAX_WORKERS)
+
+    try:
+        # Reports that already exist for this run are skipped, so an interrupted run can be resumed
+        pending = []
+        for account_manager in account_managers:
+            for report_name in report_functions:
+                if os.path.exists(get_report_path(run_id, account_manager, report_name)):
+                    with batch_runs_lock:
+                        status['skipped'].append(f"{account_manager}/{report_name}")
+                else:
+                    pending.append((account_manager, report_name))
+
+        logger.info(f"Batch run {run_id}: {len(pending)} reports pending, {len(status['skipped'])} already done")
+
+        def process(account_manager, report_name):
+            response_text = run_report(account_manager, report_name)
+            save_report(run_id, account_manager, report_name, response_text)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(process, *job): job for job in pending}
+            for future in as_completed(futures):
+                key = "/".join(futures[future])
+                try:
+                    future.result()
+                    with batch_runs_lock:
+                        status['completed'].append(key)
+                    logger.info(f"Batch run {run_id}: {key} completed")
+                except Exception as e:
+                    logging.error(f"Batch run {run_id}: {key} failed: {str(e)}", exc_info=True)
+                    with batch_runs_lock:
+                        status['failed'][key] = str(e)
+    except Exception as e:
+        logging.error(f"Batch run {run_id} aborted: {str(e)}", exc_info=True)
+        with batch_runs_lock:
+            status['error'] = str(e)
+    finally:
+        # The run never stays "running", so it can be restarted after any failure
+        with batch_runs_lock:
+            if 'error' in status:
+                status['status'] = "failed"
+            else:
+                status['status'] = "completed_with_errors" if status['failed'] else "completed"
+    return status
+
+def add_report_to_thread(user_input, response_text):
+    # Keep the conversation thread in sync so follow-up questions have the report as context
+    global thread
+    try:
+        if thread is None: thread = client.beta.threads.create()
+        create_thread_message(thread.id, "user", user_input, max_wait_seconds=30)
+        create_thread_message(thread.id, "assistant", response_text, max_wait_seconds=30)
+    except Exception as e:
+        logging.error(f"Error adding precomputed report to thread: {str(e)}", exc_info=True)
+
 # Vordefinierte Fragen oder Konzepte, zu denen du eine spezielle Antwort geben möchtest
 reference_prompts = [
     "Wo stehe ich in Hinblick auf meine quantitative Zielerreichung?",
@@ -651,10 +881,150 @@ reference_prompts = [
     "Wer sind meine produktiven Makler?"
 ]
 
+# Zuordnung der reference_prompts zu den vorberechenbaren Analysen
+reference_reports = {
+    reference_prompts[0]: "target_analyze",
+    reference_prompts[1]: "target_gap",
+    reference_prompts[2]: "productive_broker_analyze"
+}
+
+# Umschreibungen der reference_prompts zum Training des lokalen Intent-Routers
+reference_prompt_paraphrases = {
+    reference_prompts[0]: [
+        "Wie ist meine quantitative Zielerreichung?",
+        "Wo stehe ich bei meiner Zielerreichung?",
+        "Wie weit bin ich mit meiner Zielerreichung?",
+        "Zeig mir meine Zielerreichung",
+        "Übersicht meiner Zielerreichung",
+        "Wie ist der aktuelle Stand meiner Zielerreichung?"
+    ],
+    reference_prompts[1]: [
+        "Wie kann ich meine persönlichen Ziele erreichen?",
+        "Was muss ich tun, um meine persönlichen Ziele zu erreichen?",
+        "Wie schaffe ich meine persönlichen Ziele?",
+        "Was fehlt mir noch zu meinen persönlichen Zielen?"
+    ],
+    reference_prompts[2]: [
+        "Welche meiner Makler sind produktiv?",
+        "Welche Makler sind produktiv?",
+        "Zeige mir meine produktiven Makler",
+        "Liste meiner produktiven Makler",
+        "Wie viele meiner Makler sind produktiv?"
+    ]
+}
+
+# Lokaler Intent-Router: beantwortet sichere Zuordnungen ohne Embedding-Aufruf
+LOCAL_ROUTER_THRESHOLD = 0.75  # Mindestkonfidenz des lokalen Klassifikators
+LOCAL_ROUTER_MARGIN = 0.1  # Mindestabstand zum zweitbesten Intent
+
+# Füllwörter, die für die Zuordnung keine Rolle spielen; Verneinungen gehören bewusst nicht dazu
+ROUTER_STOPWORDS = {
+    'ich', 'mein', 'meine', 'meiner', 'meinen', 'meinem', 'mir', 'mich', 'wir', 'unsere', 'unser',
+    'wie', 'wo', 'wer', 'was', 'welche', 'welcher', 'welches', 'sind', 'ist', 'bin', 'es',
+    'der', 'die', 'das', 'den', 'dem', 'des', 'ein', 'eine', 'einer', 'und', 'um', 'zu', 'in', 'im',
+    'auf', 'bei', 'mit', 'fuer', 'von', 'ueber', 'steht', 'stehe', 'zeig', 'zeige', 'gib', 'bitte',
+    'mal', 'noch', 'bereits', 'schon', 'aktuell', 'aktuelle', 'aktuellen', 'hinblick', 'hinsichtlich',
+    'tun', 'muss', 'kann', 'weit', 'stand', 'uebersicht', 'liste', 'viele', 'sieht', 'aus', 'damit'
+}
+
+def normalize_prompt(text):
+    text = unicodedata.normalize('NFKC', str(text)).lower()
+    for umlaut, replacement in (('ä', 'ae'), ('ö', 'oe'), ('ü', 'ue'), ('ß', 'ss')):
+        text = text.replace(umlaut, replacement)
+    text = re.sub(r'[^a-z0-9]+', ' ', text)
+    return text.strip()
+
+def char_ngrams(text, n_min=3, n_max=5):
+    padded = f" {text} "
+    return [padded[i:i + n] for n in range(n_min, n_max + 1) for i in range(len(padded) - n + 1)]
+
+def content_words(normalized):
+    return {word for word in normalized.split() if word not in ROUTER_STOPWORDS}
+
+def words_covered(words, example_words):
+    # Flexionsformen gelten als gleich (gemeinsamer Präfix), abweichende Wortstämme wie
+    # "qualitative"/"quantitative" oder "unproduktiven"/"produktiven" dagegen nicht
+    return all(
+        any(word == example_word or (min(len(word), len(example_word)) >= 5 and word[:5] == example_word[:5])
+            for example_word in example_words)
+        for word in words
+    )
+
+class IntentRouter:
+    """Routes prompts to a reference prompt without calling the embeddings API.
+
+    Tier 1 is a hash table of normalized known prompts (``tier == "exact"``),
+    tier 2 a character n-gram TF-IDF nearest-neighbour classifier
+    (``tier == "local"``) whose matches must clear the confidence threshold
+    and margin and share all content words with the matched example.
+    ``route`` returns ``(tier, reference_prompt, confidence)``; ``tier`` is
+    ``None`` when the local confidence is too low and the caller should fall
+    back to embeddings. A ``reference_prompt`` of ``None`` means the prompt
+    is a known free-text question that matches no reference prompt.
+    """
+
+    def __init__(self, examples, threshold=LOCAL_ROUTER_THRESHOLD, margin=LOCAL_ROUTER_MARGIN):
+        self.threshold = threshold
+        self.margin = margin
+        self.exact_matches = {}
+        for text, label in examples:
+            self.exact_matches.setdefault(normalize_prompt(text), label)
+
+        documents = [(Counter(char_ngrams(normalized)), label, content_words(normalized)) for normalized, label in self.exact_matches.items()]
+        document_frequency = Counter(ngram for counts, _, _ in documents for ngram in counts)
+        self.idf = {ngram: math.log((1 + len(documents)) / (1 + df)) + 1 for ngram, df in document_frequency.items()}
+        self.vectors = [(self.vectorize(counts), label, words) for counts, label, words in documents]
+
+    def vectorize(self, counts):
+        # Unbekannte n-Gramme tragen nicht zur Ähnlichkeit bei und werden ignoriert
+        vector = {ngram: count * self.idf[ngram] for ngram, count in counts.items() if ngram in self.idf}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {ngram: weight / norm for ngram, weight in vector.items()} if norm else {}
+
+    def classify(self, normalized):
+        vector = self.vectorize(Counter(char_ngrams(normalized)))
+        best_matches = {}
+        for example_vector, label, words in self.vectors:
+            score = sum(weight * example_vector.get(ngram, 0.0) for ngram, weight in vector.items())
+            if score > best_matches.get(label, (0.0, None))[0]:
+                best_matches[label] = (score, words)
+        ranked = sorted(best_matches.items(), key=lambda item: item[1][0], reverse=True)
+        if not ranked:
+            return None, 0.0, 0.0, set()
+        label, (confidence, words) = ranked[0]
+        runner_up = ranked[1][1][0] if len(ranked) > 1 else 0.0
+        return label, confidence, confidence - runner_up, words
+
+    def route(self, user_prompt):
+        normalized = normalize_prompt(user_prompt)
+        if normalized in self.exact_matches:
+            return "exact", self.exact_matches[normalized], 1.0
+
+        label, confidence, margin, example_words = self.classify(normalized)
+        if confidence >= self.threshold and margin >= self.margin and words_covered(content_words(normalized), example_words):
+            return "local", label, confidence
+        return None, None, confidence
+
+def build_router_examples():
+    examples = [(ref_prompt, ref_prompt) for ref_prompt in reference_prompts]
+    for ref_prompt, paraphrases in reference_prompt_paraphrases.items():
+        examples.extend((paraphrase, ref_prompt) for paraphrase in paraphrases)
+    # Vorgeschlagene Folgefragen ohne passenden reference_prompt sind bekannte Freitext-Fragen
+    suggestions = [question for questions in follow_up_questions.values() for question in questions]
+    examples.extend((question, None) for question in suggestions + default_follow_up_questions)
+    return examples
+
+intent_router = IntentRouter(build_router_examples())
+
+# Embeddings werden zwischengespeichert, damit die reference_prompts nur einmal eingebettet werden
+@lru_cache(maxsize=1024)
+def get_embedding(text):
+    return client.embeddings.create(input=text, model="text-embedding-3-small").data[0].embedding
+
 # Funktion, um semantische Ähnlichkeit zwischen zwei Texten zu berechnen
 def get_semantic_similarity(prompt1, prompt2):
-    embedding1 = client.embeddings.create(input=prompt1, model="text-embedding-3-small").data[0].embedding
-    embedding2 = client.embeddings.create(input=prompt2, model="text-embedding-3-small").data[0].embedding
+    embedding1 = get_embedding(prompt1)
+    embedding2 = get_embedding(prompt2)
 
     # Berechne die Ähnlichkeit (z. B. Kosinus-Ähnlichkeit)
     similarity = cosine_similarity(embedding1, embedding2)
@@ -667,8 +1037,18 @@ def cosine_similarity(vec1, vec2):
     magnitude2 = sum(b * b for b in vec2) ** 0.5
     return dot_product / (magnitude1 * magnitude2)
 
-# Funktion zur Überprüfung der Ähnlichkeit und Rückgabe des ähnlichsten reference_prompts
+# Ähnlichsten reference_prompt bestimmen, zuerst lokal und nur bei geringer Konfidenz per Embedding
 def get_most_similar_prompt(user_prompt, reference_prompts, threshold=0.85):
+    tier, routed_prompt, confidence = intent_router.route(user_prompt)
+    if tier is not None and (routed_prompt is None or routed_prompt in reference_prompts):
+        logger.info(f"Routed locally ({tier}, confidence {confidence:.2f}): {routed_prompt}")
+        return routed_prompt
+
+    logger.info(f"Local routing confidence {confidence:.2f} too low, falling back to embeddings")
+    return get_most_similar_prompt_by_embedding(user_prompt, reference_prompts, threshold)
+
+# Funktion zur Überprüfung der Ähnlichkeit und Rückgabe des ähnlichsten reference_prompts
+def get_most_similar_prompt_by_embedding(user_prompt, reference_prompts, threshold=0.85):
     most_similar_prompt = None
     highest_similarity = threshold  # Starte mit dem Schwellwert als Basis
     
@@ -683,6 +1063,49 @@ def get_most_similar_prompt(user_prompt, reference_prompts, threshold=0.85):
     
     return most_similar_prompt
 
+# Vorschläge der App bauen auf einem Bericht auf und laufen deshalb immer auf dem vollen Assistant
+suggested_questions = {
+    normalize_prompt(question)
+    for question in [q for questions in follow_up_questions.values() for q in questions] + default_follow_up_questions
+}
+
+# Ob die letzte Frage eines Nutzers einen reference_prompt-Bericht ausgelöst hat
+report_turns = {}
+
+# Freitext-Fragen ohne passenden reference_prompt auf ein schnelleres Modell routen
+def select_model_tier(user_input, similar_prompt, follows_report=False):
+    if similar_prompt is not None or follows_report or not app.config['MODEL_ROUTING_ENABLED']:
+        return "heavy"
+    normalized = normalize_prompt(user_input)
+    if normalized in suggested_questions:
+        return "heavy"
+    if len(normalized.split()) > app.config['LIGHT_TIER_MAX_WORDS']:
+        return "heavy"
+    if any(keyword in normalized for keyword in app.config['HEAVY_TIER_KEYWORDS']):
+        return "heavy"
+    return "light"
+
+# Latenzen je Modell-Tier der letzten Anfragen
+routing_stats_lock = threading.Lock()
+routing_stats = {}
+
+def record_routing_latency(model_tier, first_token_seconds, total_seconds, failed=False):
+    # Failed runs are counted separately and kept out of the latency medians
+    with routing_stats_lock:
+        tier_stats = routing_stats.setdefault(model_tier, {
+            "count": 0,
+            "failures": 0,
+            "first_token_seconds": deque(maxlen=200),
+            "total_seconds": deque(maxlen=200)
+        })
+        tier_stats['count'] += 1
+        if failed:
+            tier_stats['failures'] += 1
+            return
+        if first_token_seconds is not None:
+            tier_stats['first_token_seconds'].append(first_token_seconds)
+        tier_stats['total_seconds'].append(total_seconds)
+
 @app.route('/chat', methods=['POST'])
 def chat():
     global user_id
@@ -701,6 +1124,23 @@ def chat():
     
     # Ähnlichsten reference_prompt finden
     similar_prompt = get_most_similar_prompt(user_input, reference_prompts)
+    follows_report = report_turns.get(user_id, False)
+    report_turns[user_id] = similar_prompt is not None
+    
+    # Vorberechneten Morgenbericht sofort ausliefern, falls vorhanden
+    report_name = reference_reports.get(similar_prompt)
+    precomputed_report = load_precomputed_report(mock_user, report_name) if report_name else None
+    if precomputed_report:
+        logger.info(f"Serving precomputed report {report_name} for {mock_user}")
+        streaming_responses[user_id].append({
+            "role": "assistant",
+            "content": precomputed_report['content'],
+            "is_streaming": False,
+            "suggestions": generate_follow_up_questions(similar_prompt)
+        })
+        # Written before responding, so a follow-up question cannot race the report into the thread
+        add_report_to_thread(user_input, precomputed_report['response'])
+        return jsonify({"status": "streaming", "user_id": user_id})
     
     # Prompt modifizieren, wenn eine Ähnlichkeit gefunden wurde
     if similar_prompt:
@@ -717,10 +1157,12 @@ def chat():
         modified_prompt = user_input
     
     prompts = modified_prompt if isinstance(modified_prompt, list) else [modified_prompt]
+    model_tier = select_model_tier(user_input, similar_prompt, follows_report)
+    logger.info(f"Model tier: {model_tier}")
     
     # Start the streaming response in a separate thread
     logger.info("Starting background task")
-    threading.Thread(target=handle_streaming_response, args=(similar_prompt, user_id, prompts, assistant_id, None)).start()
+    threading.Thread(target=handle_streaming_response, args=(similar_prompt, user_id, prompts, assistant_id, None, model_tier)).start()
     
     return jsonify({"status": "streaming", "user_id": user_id})
 
@@ -737,6 +1179,210 @@ def stream(user_id):
 
     return Response(stream_with_context(message_generator()), content_type='text/event-stream')
 
+def parse_int_param(value):
+    # Accepts JSON integers and integer strings from the query string; bools and floats are rejected
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and re.fullmatch(r'-?\d+', value.strip()):
+        return int(value)
+    raise ValueError(value)
+
+@app.route('/api/kpis', methods=['GET', 'POST'])
+def kpis():
+    # Broker IDs come as JSON list (POST) or as comma-separated / repeated query parameter (GET)
+    data = request.get_json(silent=True) if request.method == 'POST' else None
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "error": "Request body must be a JSON object"}), 400
+    params = {**request.args.to_dict(), **data}
+    raw_broker_ids = data.get('broker_ids', request.args.getlist('broker_ids'))
+    if isinstance(raw_broker_ids, (str, int)) and not isinstance(raw_broker_ids, bool):
+        raw_broker_ids = [raw_broker_ids]
+    if not isinstance(raw_broker_ids, list):
+        return jsonify({"status": "error", "error": "broker_ids must be a list, a string or an integer"}), 400
+    raw_broker_ids = [value for item in raw_broker_ids for value in str(item).split(',') if value.strip()]
+    team = params.get('team')
+    output_format = params.get('format', 'json')
+    per_broker = str(params.get('per_broker', 'true')).lower() not in ('false', '0', 'no')
+
+    try:
+        broker_ids = [int(broker_id) for broker_id in raw_broker_ids]
+        page = parse_int_param(params.get('page', 1))
+        page_size = parse_int_param(params.get('page_size', 1000))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "error": "broker_ids, page and page_size must be integers"}), 400
+    if page < 1 or not 1 <= page_size <= app.config['KPI_MAX_PAGE_SIZE']:
+        return jsonify({"status": "error", "error": f"page must be >= 1 and page_size between 1 and {app.config['KPI_MAX_PAGE_SIZE']}"}), 400
+    if output_format not in ('json', 'arrow'):
+        return jsonify({"status": "error", "error": "format must be 'json' or 'arrow'"}), 400
+    if output_format == 'arrow' and pa is None:
+        return jsonify({"status": "error", "error": "Arrow output requires pyarrow"}), 501
+
+    try:
+        df = load_kpi_data(app.config['KPI_DATA_FILE'])
+    except FileNotFoundError:
+        return jsonify({"status": "error", "error": "KPI data file not found"}), 404
+    team_column = app.config['KPI_TEAM_COLUMN']
+    if team is not None and team_column not in df.columns:
+        return jsonify({"status": "error", "error": f"KPI data has no team column '{team_column}'"}), 400
+    # Query parameters are always strings, so the team is converted to the type of the team column
+    if team is not None:
+        if pd.api.types.is_numeric_dtype(df[team_column]):
+            try:
+                if isinstance(team, bool):
+                    raise ValueError(team)
+                team = float(team)
+            except (TypeError, ValueError):
+                return jsonify({"status": "error", "error": f"team must be a number for team column '{team_column}'"}), 400
+        else:
+            team = str(team)
+
+    result = aggregate_kpis(df, broker_ids, team, team_column, per_broker)
+    total_rows = len(result)
+    result = result.iloc[(page - 1) * page_size:page * page_size]
+
+    if output_format == 'arrow':
+        sink = pa.BufferOutputStream()
+        table = pa.Table.from_pandas(result, preserve_index=False)
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        response = Response(sink.getvalue().to_pybytes(), content_type='application/vnd.apache.arrow.stream')
+        response.headers['X-Total-Rows'] = str(total_rows)
+        response.headers['X-Page'] = str(page)
+        response.headers['X-Page-Size'] = str(page_size)
+        return response
+
+    return jsonify({
+        "total_rows": total_rows,
+        "page": page,
+        "page_size": page_size,
+        "columns": list(result.columns),
+        "data": {column: result[column].tolist() for column in result.columns}
+    })
+
+def is_admin_request():
+    return bool(admin_token) and request.headers.get('X-Admin-Token') == admin_token
+
+@app.route('/admin/batch_reports', methods=['POST'])
+def start_batch_reports():
+    if not is_admin_request():
+        return jsonify({"status": "error", "error": "Forbidden"}), 403
+
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "error": "Request body must be a JSON object"}), 400
+
+    account_managers = data.get('account_managers', [mock_user])
+    if not isinstance(account_managers, list) or not account_managers or not all(isinstance(name, str) and name.strip() for name in account_managers):
+        return jsonify({"status": "error", "error": "account_managers must be a non-empty list of names"}), 400
+
+    run_id = data.get('run_id', time.strftime('%Y-%m-%d'))
+    if not isinstance(run_id, str) or not secure_filename(run_id):
+        return jsonify({"status": "error", "error": "run_id must be a non-empty string"}), 400
+
+    max_workers = data.get('max_workers', BATCH_MAX_WORKERS)
+    if not isinstance(max_workers, int) or isinstance(max_workers, bool):
+        return jsonify({"status": "error", "error": "max_workers must be an integer"}), 400
+    max_workers = min(max(max_workers, 1), BATCH_MAX_WORKERS)
+
+    # Claim the run before starting the thread, so two requests cannot start the same run
+    status = claim_batch_run(run_id)
+    if status is None:
+        return jsonify({"status": "error", "error": f"Batch run {run_id} is already running"}), 409
+
+    logger.info(f"Starting batch run {run_id} for {len(account_managers)} account managers with {max_workers} workers")
+    threading.Thread(target=run_batch_reports, args=(account_managers, run_id, max_workers, status)).start()
+    return jsonify({"status": "started", "run_id": run_id}), 202
+
+@app.route('/admin/batch_reports/<run_id>', methods=['GET'])
+def batch_report_status(run_id):
+    if not is_admin_request():
+        return jsonify({"status": "error", "error": "Forbidden"}), 403
+    # Copy under the lock, the worker thread updates the status while the run is going
+    with batch_runs_lock:
+        status = copy.deepcopy(batch_runs.get(run_id))
+    if status is None:
+        return jsonify({"status": "unknown", "run_id": run_id}), 404
+    return jsonify(status)
+
+@app.route('/admin/routing_stats', methods=['GET'])
+def routing_stats_summary():
+    if not is_admin_request():
+        return jsonify({"status": "error", "error": "Forbidden"}), 403
+
+    summary = {}
+    with routing_stats_lock:
+        for model_tier, tier_stats in routing_stats.items():
+            summary[model_tier] = {
+                "count": tier_stats['count'],
+                "failures": tier_stats['failures'],
+                "median_first_token_seconds": statistics.median(tier_stats['first_token_seconds']) if tier_stats['first_token_seconds'] else None,
+                "median_total_seconds": statistics.median(tier_stats['total_seconds']) if tier_stats['total_seconds'] else None
+            }
+    return jsonify({"enabled": app.config['MODEL_ROUTING_ENABLED'], "tiers": summary})
+
+@app.cli.command('evaluate-router')
+@click.option('--eval-file', default=ROUTER_EVAL_FILE, show_default=True, help='JSON file with held-out prompts and their expected reference prompt.')
+@click.option('--embeddings/--no-embeddings', default=True, help='Also evaluate the embedding approach (calls the embeddings API).')
+def evaluate_router_command(eval_file, embeddings):
+    """Compare the local intent router against the embedding approach."""
+    with open(eval_file, encoding='utf-8') as f:
+        eval_set = json.load(f)
+
+    results = {"total": len(eval_set), "exact_handled": 0, "local_handled": 0,
+               "network_free_correct": 0, "local_false_positives": 0}
+    if embeddings:
+        results.update({"routed_correct": 0, "embedding_correct": 0, "agreement": 0})
+    local_seconds = 0.0
+
+    for case in eval_set:
+        start = time.perf_counter()
+        tier, candidate, confidence = intent_router.route(case['prompt'])
+        local_seconds += time.perf_counter() - start
+
+        if tier is not None:
+            results[f'{tier}_handled'] += 1
+            results['network_free_correct'] += candidate == case['expected']
+            # A local match for the wrong report serves a wrong canned answer
+            results['local_false_positives'] += candidate is not None and candidate != case['expected']
+        if tier is not None and candidate != case['expected']:
+            click.echo(f"MISS ({tier}, {confidence:.2f}): {case['prompt']!r} -> {candidate!r}, expected {case['expected']!r}")
+
+        if embeddings:
+            routed_prompt = get_most_similar_prompt(case['prompt'], reference_prompts)
+            embedding_prompt = get_most_similar_prompt_by_embedding(case['prompt'], reference_prompts)
+            results['routed_correct'] += routed_prompt == case['expected']
+            results['embedding_correct'] += embedding_prompt == case['expected']
+            results['agreement'] += routed_prompt == embedding_prompt
+            if routed_prompt != case['expected']:
+                click.echo(f"MISS (routed): {case['prompt']!r} -> {routed_prompt!r}, expected {case['expected']!r}")
+
+    network_free = results['exact_handled'] + results['local_handled']
+    results['network_free_share'] = network_free / max(results['total'], 1)
+    results['network_free_accuracy'] = results['network_free_correct'] / max(network_free, 1)
+    if embeddings:
+        results['routed_accuracy'] = results['routed_correct'] / max(results['total'], 1)
+        results['embedding_accuracy'] = results['embedding_correct'] / max(results['total'], 1)
+    results['local_ms_per_prompt'] = 1000 * local_seconds / max(results['total'], 1)
+    click.echo(json.dumps(results, indent=2))
+
+@app.cli.command('batch-reports')
+@click.argument('account_managers', nargs=-1)
+@click.option('--run-id', default=None, help='Run identifier, defaults to today. Reusing it resumes an interrupted run.')
+@click.option('--workers', default=BATCH_MAX_WORKERS, show_default=True, help=f'Number of reports generated in parallel (1-{BATCH_MAX_WORKERS}).')
+def batch_reports_command(account_managers, run_id, workers):
+    """Precompute the reports for the given account managers."""
+    if run_id is not None and not secure_filename(run_id):
+        raise click.BadParameter('run_id must contain at least one letter or digit', param_hint='--run-id')
+    try:
+        status = run_batch_reports(list(account_managers) or [mock_user], run_id, workers)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(status, ensure_ascii=False, indent=2))
+
 if __name__ == '__main__':
     logger.info('Main executed')
     #app.run(host='0.0.0.0', port=8080, debug=False)